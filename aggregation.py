@@ -4,27 +4,118 @@ import logging
 import logging.handlers
 import threading
 import configparser
+import calendar
 import sys
 import json
 import signal
+import queue
 import zlib
 import ssl
 import time
-from datetime import datetime, timezone
+from datetime import datetime
+from dataclasses import dataclass
 import paho.mqtt.client as mqtt
 from sqlalchemy import create_engine, ForeignKey, Column, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 
+try:
+    import orjson
+
+    def json_dumps(obj):
+        # orjson serializes directly to bytes
+        return orjson.dumps(obj)
+
+    def json_loads(payload):
+        return orjson.loads(payload)
+except ImportError:
+    # Fall back to the stdlib serializer with the same bytes-in/bytes-out signature
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def json_loads(payload):
+        # Unlike orjson, the stdlib parser can't read a memoryview
+        if isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        return json.loads(payload)
+
+
+# Common zlib stream headers (deflate with 32K window, all compression levels)
+ZLIB_HEADERS = (b'\x78\x01', b'\x78\x5e', b'\x78\x9c', b'\x78\xda')
+
+# Inflater constructor, bound once; each zlib stream needs its own
+# decompressobj since its state can't be reset between messages
+new_inflater = zlib.decompressobj
+
 
 class Utils:
     def iso_to_tstamp(iso_time):
-        # Parse time string (time is handled in UTC)
-        time_iso = iso_time
-        time_dt = datetime.strptime(time_iso, '%Y-%m-%dT%H:%M:%SZ')
-        time_dt = time_dt.replace(tzinfo=timezone.utc)
-        timestamp = int(time_dt.timestamp())
-        return timestamp
+        # Parse the fixed-format time string 'YYYY-MM-DDTHH:MM:SSZ'
+        # by field position (time is handled in UTC); this avoids
+        # strptime, which dominates the per-message cost
+        return calendar.timegm((int(iso_time[0:4]), int(iso_time[5:7]), int(iso_time[8:10]),
+                                int(iso_time[11:13]), int(iso_time[14:16]), int(iso_time[17:19]),
+                                0, 0, 0))
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    # All configuration, snapshotted once at startup so steady-state
+    # code reads plain attributes instead of traversing configparser
+
+    # [Aggregator]
+    update_interval: int
+    include_contacts: bool
+    max_decompressed: int
+
+    # [MQTT Auth]
+    mqtt_host: str
+    mqtt_port: int
+    mqtt_use_tls: bool
+    mqtt_cacert: str
+    mqtt_insecure: bool
+    mqtt_user: str
+    mqtt_password: str
+
+    # [MQTT Channels]
+    channel_sensors_prefix: str
+    channel_nameupdate: str
+    channel_stones: str
+    channel_graph: str
+    channel_names: str
+
+    # [Database]
+    db_logging: bool
+    db_host: str
+    db_port: int
+    db_user: str
+    db_password: str
+    db_name: str
+
+    @staticmethod
+    def from_config(config):
+        return Settings(
+            update_interval=config.getint('Aggregator', 'UpdateInterval', fallback=4),
+            include_contacts=config.getboolean('Aggregator', 'StoneInfoIncludeContacts', fallback=True),
+            max_decompressed=config.getint('Aggregator', 'MaxDecompressedBytes', fallback=2 * 1024 * 1024),
+            mqtt_host=config.get('MQTT Auth', 'Hostname', fallback='127.0.0.1'),
+            mqtt_port=config.getint('MQTT Auth', 'Port', fallback=1883),
+            mqtt_use_tls=config.getboolean('MQTT Auth', 'UseTLS', fallback=False),
+            mqtt_cacert=config.get('MQTT Auth', 'CACert', fallback='server.pem'),
+            mqtt_insecure=config.getboolean('MQTT Auth', 'Insecure', fallback=False),
+            mqtt_user=config.get('MQTT Auth', 'Username', fallback='Aggregator'),
+            mqtt_password=config.get('MQTT Auth', 'Password', fallback=''),
+            channel_sensors_prefix=config.get('MQTT Channels', 'ChannelPrefixSensors', fallback='JellingStone/'),
+            channel_nameupdate=config.get('MQTT Channels', 'ChannelNameUpdates', fallback='NameUpdate'),
+            channel_stones=config.get('MQTT Channels', 'ChannelStoneInfo', fallback='Aggregated/Stones'),
+            channel_graph=config.get('MQTT Channels', 'ChannelGraphInfo', fallback='Aggregated/Graph'),
+            channel_names=config.get('MQTT Channels', 'ChannelNames', fallback='Aggregated/Names'),
+            db_logging=config.getboolean('Database', 'EnableLogging', fallback=False),
+            db_host=config.get('Database', 'Hostname', fallback='localhost'),
+            db_port=config.getint('Database', 'Port', fallback=3306),
+            db_user=config.get('Database', 'Username', fallback='aggregator'),
+            db_password=config.get('Database', 'Password', fallback=''),
+            db_name=config.get('Database', 'Database', fallback='fieldtracks'))
 
 
 class BeaconId:
@@ -33,19 +124,28 @@ class BeaconId:
     # is if all devices provide a
     # unique, non-changing MAC address
 
+    __slots__ = ('uuid', 'major', 'minor', '_hash')
+
     def __init__(self, uuid, major, minor):
         self.uuid = uuid
         self.major = major
         self.minor = minor
+        self._hash = hash((uuid, major, minor))
 
     def __eq__(self, other):
         return (self.uuid, self.major, self.minor) == (other.uuid, other.major, other.minor)
 
     def __hash__(self):
-        return hash((self.uuid, self.major, self.minor))
+        return self._hash
+
+
+# Shared id for contacts that don't carry beacon identification
+EMPTY_BEACON = BeaconId('', 0, 0)
 
 
 class Contact:
+    __slots__ = ('timestamp', 'mac_address', 'b_address', 'rssi_min', 'rssi_max', 'rssi_avg', 'tx_rssi')
+
     def __init__(self, timestamp, mac_address, b_address, rssi_min, rssi_max, rssi_avg, tx_rssi):
         self.timestamp = timestamp
         self.mac_address = mac_address
@@ -57,6 +157,11 @@ class Contact:
 
 
 class Stone:
+    __slots__ = ('mac_address', 'b_address', 'comment', 'last_update', 'last_update_ts',
+                 '_mac_key', '_hdr_frag', '_stones_frag', '_graph_frag',
+                 'ct_timestamps', 'ct_macs', 'ct_uuids', 'ct_majors', 'ct_minors',
+                 'ct_rssi_mins', 'ct_rssi_maxs', 'ct_rssi_avgs', 'ct_tx_rssis')
+
     def __init__(self, mac_address, b_address, comment):
         # Static data
         self.mac_address = mac_address
@@ -65,32 +170,96 @@ class Stone:
 
         # Updates
         self.last_update = ''
-        self.contacts = []
+        self.last_update_ts = 0
+
+        # Static JSON pieces, serialized once here and spliced into
+        # every fragment rebuild below
+        self._mac_key = json_dumps(mac_address)
+        self._hdr_frag = json_dumps({'uuid': b_address.uuid, 'major': b_address.major, 'minor': b_address.minor, 'comment': comment})[1:-1]
+
+        # Serialized fragments for the aggregated messages, built lazily
+        # by the Aggregator and dropped whenever the stone changes
+        self._stones_frag = None
+        self._graph_frag = None
+
+        # Contacts are kept column-wise (one list per field) so the
+        # aggregators can walk plain lists instead of per-contact objects.
+        # Timestamps are parsed to epoch seconds once, at ingest time.
+        self.ct_timestamps = []
+        self.ct_macs = []
+        self.ct_uuids = []
+        self.ct_majors = []
+        self.ct_minors = []
+        self.ct_rssi_mins = []
+        self.ct_rssi_maxs = []
+        self.ct_rssi_avgs = []
+        self.ct_tx_rssis = []
 
     def update(self, iso_time, recent_contacts):
         # We assume for now that updates are fairly recent
         # NOTE: This might change in the future if we
         # queue and send messages via LoRaWAN
         self.last_update = iso_time
-        timestamp = Utils.iso_to_tstamp(iso_time)
+        self.last_update_ts = Utils.iso_to_tstamp(iso_time)
+
+        # Contact objects only exist at the parse boundary; here they
+        # are broken up into rows for the column store
+        self._merge_rows(self.last_update_ts, [(Utils.iso_to_tstamp(ct.timestamp), ct.mac_address,
+                                                ct.b_address.uuid, ct.b_address.major, ct.b_address.minor,
+                                                ct.rssi_min, ct.rssi_max, ct.rssi_avg, ct.tx_rssi)
+                                               for ct in recent_contacts])
+
+    def merge_previous(self, previous):
+        # Copy-on-write merge: fold the surviving contacts of the stone
+        # being replaced into this freshly parsed one. `previous` is
+        # never mutated, so publisher snapshots that still hold it keep
+        # a consistent view
+        own_rows = self._rows()
+        self._set_rows(previous._rows())
+        self._merge_rows(self.last_update_ts, own_rows)
+
+    def _rows(self):
+        return list(zip(self.ct_timestamps, self.ct_macs, self.ct_uuids,
+                        self.ct_majors, self.ct_minors, self.ct_rssi_mins,
+                        self.ct_rssi_maxs, self.ct_rssi_avgs, self.ct_tx_rssis))
+
+    def _merge_rows(self, timestamp, new_rows):
+        # Any change invalidates the cached fragments
+        self._stones_frag = None
+        self._graph_frag = None
 
         # Remove contacts that are older than 60 seconds
-        self.contacts = [c for c in self.contacts if Utils.iso_to_tstamp(c.timestamp) >= (timestamp - 60)]
+        cutoff = timestamp - 60
+        by_mac = {r[1]: r for r in self._rows() if r[0] >= cutoff}
 
-        # Update or add new contacts
-        for ct in recent_contacts:
-            self.contacts = list(filter(lambda x : x.mac_address != ct.mac_address, self.contacts))
-            self.contacts.append(ct)
+        # Update or add new contacts, replacing by MAC address in O(1)
+        for row in new_rows:
+            by_mac[row[1]] = row
+
+        self._set_rows(list(by_mac.values()))
+
+    def _set_rows(self, rows):
+        (self.ct_timestamps, self.ct_macs, self.ct_uuids, self.ct_majors,
+         self.ct_minors, self.ct_rssi_mins, self.ct_rssi_maxs,
+         self.ct_rssi_avgs, self.ct_tx_rssis) = \
+            [list(col) for col in zip(*rows)] if rows else [[] for _ in range(9)]
 
 
 class World:
     def __init__(self):
         self.stones = {} # Contains stones: mac => stone
         self.descs = {} # Contains descriptions for nodes: mac => (name, color)
-        self.lock = threading.Lock()
 
-    def get_lock(self):
-        return self.lock
+        # Separate locks: sensor updates and name updates touch
+        # disjoint data and don't need to contend with each other
+        self.stones_lock = threading.Lock()
+        self.descs_lock = threading.Lock()
+
+    def get_stones_lock(self):
+        return self.stones_lock
+
+    def get_descs_lock(self):
+        return self.descs_lock
 
     def get_stones(self):
         return self.stones
@@ -99,39 +268,76 @@ class World:
         return self.descs
 
     def update_stone(self, stone):
-        with self.get_lock():
-            if stone.mac_address not in self.stones:
-                self.stones[stone.mac_address] = stone
-            else:
-                self.stones[stone.mac_address].update(stone.last_update, stone.contacts)
+        # Stones are replaced, never mutated in place: once an instance
+        # is in the dict it may sit in a publisher snapshot, where only
+        # the publisher thread touches its fragment caches
+        with self.get_stones_lock():
+            previous = self.stones.get(stone.mac_address)
+            if previous is not None:
+                stone.merge_previous(previous)
+            self.stones[stone.mac_address] = stone
 
     def update_desc(self, mac_address, name, color):
-        with self.get_lock():
+        with self.get_descs_lock():
             self.descs[mac_address] = (name, color)
 
 
 class Aggregator:
+    # Snapshot of the config flag, taken once at startup in Main so the
+    # per-stone loop doesn't pay a configparser lookup
+    include_contacts = True
+
+    @staticmethod
+    def contact_frag(ct_mac, ct_uuid, ct_major, ct_minor, ct_avg, ct_tx):
+        # Hand-assembled contact object, without the closing brace so
+        # the graph path can append its age field; the constant keys
+        # are baked into the template and only the two strings go
+        # through the serializer
+        return (b'{"mac":' + json_dumps(ct_mac) + b',"uuid":' + json_dumps(ct_uuid) +
+                b',"major":' + str(ct_major).encode('ascii') +
+                b',"minor":' + str(ct_minor).encode('ascii') +
+                b',"rssi_avg":' + str(ct_avg).encode('ascii') +
+                b',"rssi_tx":' + str(ct_tx).encode('ascii'))
+
     @staticmethod
     def aggregate_stones(stones):
-        # Create list of stones
-        stones_info = dict()
-        for mac, s in stones.items():
-            stones_info[mac] = {'uuid': s.b_address.uuid, 'major': s.b_address.major, 'minor': s.b_address.minor, 'comment': s.comment, 'timestamp': s.last_update}
-            if CONFIG.getboolean('Aggregator', 'StoneInfoIncludeContacts', fallback=True):
-                stones_info[mac]['contacts'] = list()
-                for c in s.contacts:
-                    stones_info[mac]['contacts'].append({'mac': c.mac_address, 'uuid': c.b_address.uuid, 'major': c.b_address.major, 'minor': c.b_address.minor, 'rssi_avg': c.rssi_avg, 'rssi_tx': c.tx_rssi})
-        return json.dumps(stones_info)
+        # Stitch the message from per-stone fragments so only stones
+        # that changed since the last publish get re-serialized
+        frags = []
+        for s in stones:
+            if s._stones_frag is None:
+                frag = s._mac_key + b':{' + s._hdr_frag + b',"timestamp":' + json_dumps(s.last_update)
+                if Aggregator.include_contacts:
+                    contacts = b','.join(Aggregator.contact_frag(ct_mac, ct_uuid, ct_major, ct_minor, ct_avg, ct_tx) + b'}'
+                                         for ct_mac, ct_uuid, ct_major, ct_minor, ct_avg, ct_tx
+                                         in zip(s.ct_macs, s.ct_uuids, s.ct_majors, s.ct_minors, s.ct_rssi_avgs, s.ct_tx_rssis))
+                    frag += b',"contacts":[' + contacts + b']'
+                s._stones_frag = frag + b'}'
+            frags.append(s._stones_frag)
+        return b'{' + b','.join(frags) + b'}'
 
     @staticmethod
     def aggregate_graph(stones, current_time):
-        # Create list of stones
-        stones_info = dict()
-        for mac, s in stones.items():
-            stones_info[mac] = {'uuid': s.b_address.uuid, 'major': s.b_address.major, 'minor': s.b_address.minor, 'comment': s.comment, 'age': current_time - Utils.iso_to_tstamp(s.last_update), 'contacts': []}
-            for c in s.contacts:
-                stones_info[mac]['contacts'].append({'mac': c.mac_address, 'uuid': c.b_address.uuid, 'major': c.b_address.major, 'minor': c.b_address.minor, 'age': current_time - Utils.iso_to_tstamp(c.timestamp), 'rssi_avg': c.rssi_avg, 'rssi_tx': c.tx_rssi})
-        return json.dumps(stones_info)
+        # The age fields change on every publish, so the cached fragments
+        # cover everything but the ages, which get appended at emit time
+        frags = []
+        for s in stones:
+            if s._graph_frag is None:
+                # Header and per-contact fragments, each missing the
+                # trailing '"age":N}' part. The timestamps the ages are
+                # computed from live in the same atomically-assigned
+                # tuple, so a reader can never pair fragments with
+                # timestamps from a different generation of the stone
+                ct_frags = [Aggregator.contact_frag(ct_mac, ct_uuid, ct_major, ct_minor, ct_avg, ct_tx)
+                            for ct_mac, ct_uuid, ct_major, ct_minor, ct_avg, ct_tx
+                            in zip(s.ct_macs, s.ct_uuids, s.ct_majors, s.ct_minors, s.ct_rssi_avgs, s.ct_tx_rssis)]
+                s._graph_frag = (s._mac_key + b':{' + s._hdr_frag, ct_frags, s.ct_timestamps, s.last_update_ts)
+            hdr_frag, ct_frags, ct_timestamps, last_update_ts = s._graph_frag
+            contacts = b','.join(cf + b',"age":' + str(current_time - ts).encode('ascii') + b'}'
+                                 for cf, ts in zip(ct_frags, ct_timestamps))
+            frags.append(hdr_frag + b',"age":' + str(current_time - last_update_ts).encode('ascii') +
+                         b',"contacts":[' + contacts + b']}')
+        return b'{' + b','.join(frags) + b'}'
 
     @staticmethod
     def aggregate_descs(descriptions):
@@ -139,117 +345,152 @@ class Aggregator:
         descs_info = dict()
         for mac in descriptions:
             descs_info[mac] = {'name': descriptions[mac][0], 'color': descriptions[mac][1]}
-        return json.dumps(descs_info)
+        return json_dumps(descs_info)
 
 
 class MqttService:
-    def __init__(self, world, dbs):
+    def __init__(self, world, dbs, settings):
         self.world = world
         self.dbs = dbs
         self.is_running = True
 
-        host = CONFIG.get('MQTT Auth', 'Hostname', fallback='127.0.0.1')
-        port = CONFIG.getint('MQTT Auth', 'Port', fallback=1883)
-        usetls = CONFIG.getboolean('MQTT Auth', 'UseTLS', fallback=False)
-        cacert = CONFIG.get('MQTT Auth', 'CACert', fallback='server.pem')
-        insecure = CONFIG.getboolean('MQTT Auth', 'Insecure', fallback=False)
-        user = CONFIG.get('MQTT Auth', 'Username', fallback='Aggregator')
-        passwd = CONFIG.get('MQTT Auth', 'Password', fallback='')
+        # Received messages are handed from the network thread to the
+        # parsing loop through this queue; None is the shutdown sentinel
+        self.msg_queue = queue.SimpleQueue()
 
-        self.channel_in_sensors_prefix = CONFIG.get('MQTT Channels', 'ChannelPrefixSensors', fallback='JellingStone/')
+        # Last retained payload per topic, to skip no-op republishes
+        self.last_published = {}
+
+        self.channel_in_sensors_prefix = settings.channel_sensors_prefix
+        self.prefix_len = len(self.channel_in_sensors_prefix)
         self.channel_in_sensors = self.channel_in_sensors_prefix + '+'
-        self.channel_in_nameupdate = CONFIG.get('MQTT Channels', 'ChannelNameUpdates', fallback='NameUpdate')
-        self.channel_out_stones = CONFIG.get('MQTT Channels', 'ChannelStoneInfo', fallback='Aggregated/Stones')
-        self.channel_out_graph = CONFIG.get('MQTT Channels', 'ChannelGraphInfo', fallback='Aggregated/Graph')
-        self.channel_out_names = CONFIG.get('MQTT Channels', 'ChannelNames', fallback='Aggregated/Names')
-
-        self.client = mqtt.Client('Aggregator')
-        self.client.username_pw_set(user, passwd)
-        if usetls:
-            self.client.tls_set(cacert, tls_version=ssl.PROTOCOL_TLSv1_2)
-            if insecure:
+        self.channel_in_nameupdate = settings.channel_nameupdate
+        self.channel_out_stones = settings.channel_stones
+        self.channel_out_graph = settings.channel_graph
+        self.channel_out_names = settings.channel_names
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id='Aggregator',
+                                  reconnect_on_failure=True)
+        self.client.username_pw_set(settings.mqtt_user, settings.mqtt_password)
+        if settings.mqtt_use_tls:
+            self.client.tls_set(settings.mqtt_cacert, tls_version=ssl.PROTOCOL_TLSv1_2)
+            if settings.mqtt_insecure:
                 self.client.tls_insecure_set(True)
         self.client.reconnect_delay_set(min_delay=1, max_delay=30)
 
         self.client.on_message = self.on_message
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
-        self.client.connect(host, port)
+        self.client.connect(settings.mqtt_host, settings.mqtt_port)
+
+        self.update_interval = settings.update_interval
+        self.max_decompressed = settings.max_decompressed
 
-        self.update_interval = CONFIG.getint('Aggregator', 'UpdateInterval', fallback=4)
-        self.last_stone_update = 0
+        # Aggregated data is published on a fixed cadence, decoupled
+        # from message ingress so a quiet network still gets updates
+        # and a busy one doesn't serialize inside the receive path
+        self.publish_thread = threading.Thread(target=self.publish_loop, daemon=True)
+        self.publish_thread.start()
 
 
+    def publish_loop(self):
+        while self.is_running:
+            time.sleep(self.update_interval)
+            self.publish_aggregates()
+
+    def publish_aggregates(self):
+        with self.world.get_stones_lock():
+            # Take a shallow snapshot so serialization doesn't
+            # block other message handlers on the world lock
+            snapshot = list(self.world.get_stones().values())
+        agg_stones = Aggregator.aggregate_stones(snapshot)
+        agg_graph = Aggregator.aggregate_graph(snapshot, int(time.time()))
+        self.publish_persistent(self.channel_out_stones, agg_stones)
+        self.publish_persistent(self.channel_out_graph, agg_graph)
+
     def watch_mqtt(self):
-        self.client.loop_forever()
+        # The network loop runs on its own thread; messages are parsed
+        # here so heavy aggregation can't stall packet reception and
+        # starve the broker keepalive
+        self.client.loop_start()
+        while True:
+            item = self.msg_queue.get()
+            if item is None:
+                break
+            self.handle_message(*item)
 
     def stop(self):
         self.is_running = False
         self.client.disconnect()
+        self.client.loop_stop()
+        self.msg_queue.put(None)
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, reason_code, properties):
         self.client.subscribe(self.channel_in_sensors)
         self.client.subscribe(self.channel_in_nameupdate)
         self.client.subscribe(self.channel_out_names)
         logging.info('MQTT connected!')
 
-    def on_disconnect(self, client, userdata, rc):
-        if self.is_running and rc != mqtt.MQTT_ERR_SUCCESS:
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        if self.is_running and reason_code != 0:
             logging.warning('Lost connection to the MQTT broker!')
         else:
             logging.info('MQTT disconnected!')
 
     def on_message(self, client, userdata, message):
-        topic = message.topic
-        payload = message.payload
+        # Runs on the network thread: only hand the message over, all
+        # parsing happens on the watch_mqtt loop
+        self.msg_queue.put_nowait((message.topic, message.payload))
+
+    def handle_message(self, topic, payload):
+        # Hoist the channel names into locals; they are compared on
+        # every single message
+        sensors_prefix = self.channel_in_sensors_prefix
+        nameupdate_channel = self.channel_in_nameupdate
+        # A view over the payload; parsing never needs a mutable copy
+        payload = memoryview(payload)
 
         try:
             # Check for zlib header and decompress if neccessary
-            if payload[0] == 0x78 and payload[1] == 0x9c:
-                payload = zlib.decompress(payload)
+            if payload[:2] in ZLIB_HEADERS:
+                payload = self.decompress_capped(payload)
 
             # Get data from json
-            data = json.loads(payload.decode('utf-8'))
+            data = json_loads(payload)
         except Exception as e:
             logging.warning('Could not decode message of length {} in topic {}'.format(len(payload), topic))
             return
 
-        if topic.startswith(self.channel_in_sensors_prefix):
+        if topic.startswith(sensors_prefix):
             # Parse data into Stone object
-            mac_address = topic[len(self.channel_in_sensors_prefix):]
+            mac_address = topic[self.prefix_len:]
             stone = Stone(mac_address, BeaconId(data['uuid'], data['major'], data['minor']), data['comment'])
 
             # Add contacts
-            contacts = list()
-            for ct in data['data']:
-                bid = BeaconId(ct['uuid'], ct['major'], ct['minor']) if ('uuid' in ct and 'major' in ct and 'minor' in ct) else BeaconId('', 0, 0)
-                contacts.append(Contact(data['timestamp'], ct['mac'], bid, ct['min'], ct['max'], ct['avg'], ct['remoteRssi']))
+            contacts = [Contact(data['timestamp'], ct['mac'],
+                                BeaconId(ct['uuid'], ct['major'], ct['minor'])
+                                if ('uuid' in ct and 'major' in ct and 'minor' in ct) else EMPTY_BEACON,
+                                ct['min'], ct['max'], ct['avg'], ct['remoteRssi'])
+                        for ct in data['data']]
             stone.update(data['timestamp'], contacts)
 
-            # Update world model
-            self.world.update_stone(stone)
-
-            # Publish aggregated data
-            if(time.time() - self.last_stone_update) >= self.update_interval:
-                self.last_stone_update = time.time()
-                with self.world.get_lock():
-                    agg_stones = Aggregator.aggregate_stones(self.world.get_stones())
-                    agg_graph = Aggregator.aggregate_graph(self.world.get_stones(), Utils.iso_to_tstamp(data['timestamp']))
-                self.publish_persistent(self.channel_out_stones, agg_stones.encode('utf-8'))
-                self.publish_persistent(self.channel_out_graph, agg_graph.encode('utf-8'))
-
-            # Store stone event in database
+            # Store stone event in database, before the world merge
+            # folds older surviving contacts into this stone
             if self.dbs is not None:
                 self.dbs.store_event(stone)
 
-        elif topic == self.channel_in_nameupdate:
+            # Update world model
+            self.world.update_stone(stone)
+
+        elif topic == nameupdate_channel:
             # Update the description
             self.world.update_desc(data['mac'], data['name'], data['color'])
 
             # Compose and pin a new message with all names
-            with self.world.get_lock():
-                agg_descs = Aggregator.aggregate_descs(self.world.get_descs())
-            self.publish_persistent(self.channel_out_names, agg_descs.encode('utf-8'))
+            with self.world.get_descs_lock():
+                descs = dict(self.world.get_descs())
+            agg_descs = Aggregator.aggregate_descs(descs)
+            self.publish_persistent(self.channel_out_names, agg_descs)
 
         elif topic == self.channel_out_names:
             # This should pick up the last retained aggregated names on startup
@@ -272,7 +513,22 @@ class MqttService:
             logging.info('Imported {} descriptions from last aggregated message'.format(num_imported))
 
 
+    def decompress_capped(self, payload):
+        # Cap the decompressed size so a small compressed message can't
+        # expand into unbounded memory (decompression bomb)
+        decomp = new_inflater()
+        data = decomp.decompress(payload, self.max_decompressed)
+        if decomp.unconsumed_tail:
+            raise ValueError('Decompressed message exceeds MaxDecompressedBytes')
+        return data
+
     def publish_persistent(self, topic, payload):
+        # The serializer output is deterministic, so an identical
+        # payload means the retained message wouldn't change; skip it
+        # and save broker bandwidth and subscriber wakeups
+        if self.last_published.get(topic) == payload:
+            return
+        self.last_published[topic] = payload
         self.client.publish(topic, payload, retain=True)
 
 
@@ -308,14 +564,9 @@ class DBService:
 
         contacts = relationship('SensorContact', back_populates='stone_event')
 
-    def __init__(self):
-        host = CONFIG.get('Database', 'Hostname', fallback='localhost')
-        port = CONFIG.getint('Database', 'Port', fallback=3306)
-        user = CONFIG.get('Database', 'Username', fallback='aggregator')
-        passwd = CONFIG.get('Database', 'Password', fallback='')
-        db = CONFIG.get('Database', 'Database', fallback='fieldtracks')
-
-        self.engine = create_engine('mysql+mysqldb://{}:{}@{}:{}/{}'.format(user, passwd, host, port, db))
+    def __init__(self, settings):
+        self.engine = create_engine('mysql+mysqldb://{}:{}@{}:{}/{}'.format(
+            settings.db_user, settings.db_password, settings.db_host, settings.db_port, settings.db_name))
         DBService.Base.metadata.create_all(self.engine)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
@@ -324,22 +575,22 @@ class DBService:
         self.session.close()
 
     def store_event(self, stone):
-        time = datetime.utcfromtimestamp(stone.last_update)
+        time = datetime.utcfromtimestamp(stone.last_update_ts)
         db_stone = DBService.StoneEvent(mac=stone.mac_address,
                                         uuid=stone.b_address.uuid,
                                         major=stone.b_address.major,
                                         minor=stone.b_address.minor,
                                         timestamp=time,
                                         comment=stone.comment)
-        for contact in stone.contacts:
-            db_contact = DBService.SensorContact(mac=contact.mac_address,
-                                                 uuid=contact.b_address.uuid,
-                                                 major=contact.b_address.major,
-                                                 minor=contact.b_address.minor,
-                                                 min=contact.rssi_min,
-                                                 max=contact.rssi_max,
-                                                 avg=contact.rssi_avg,
-                                                 remote_rssi=contact.tx_rssi)
+        for _, ct_mac, ct_uuid, ct_major, ct_minor, ct_min, ct_max, ct_avg, ct_tx in stone._rows():
+            db_contact = DBService.SensorContact(mac=ct_mac,
+                                                 uuid=ct_uuid,
+                                                 major=ct_major,
+                                                 minor=ct_minor,
+                                                 min=ct_min,
+                                                 max=ct_max,
+                                                 avg=ct_avg,
+                                                 remote_rssi=ct_tx)
             db_stone.contacts.append(db_contact)
 
         self.session.add(db_stone)
@@ -354,9 +605,10 @@ class Main:
 
         # Won't check for now if the config file is valid
         # Falls back to default values if options are missing
-        global CONFIG
-        CONFIG = configparser.ConfigParser()
-        CONFIG.read(sys.argv[1])
+        config = configparser.ConfigParser()
+        config.read(sys.argv[1])
+        self.settings = Settings.from_config(config)
+        Aggregator.include_contacts = self.settings.include_contacts
 
         # Configure logging
         logging.basicConfig(
@@ -368,15 +620,15 @@ class Main:
         self.world = World()
 
         # Setup database
-        if CONFIG.getboolean('Database', 'EnableLogging', fallback=False):
+        if self.settings.db_logging:
             logging.info('Setting up database...')
-            self.dbs = DBService()
+            self.dbs = DBService(self.settings)
         else:
             self.dbs = None
 
         # Setup the MQTT service for communication
         logging.info('Starting MQTT service...')
-        self.mqtts = MqttService(self.world, self.dbs)
+        self.mqtts = MqttService(self.world, self.dbs, self.settings)
 
         # Catch sigints
         signal.signal(signal.SIGINT, self.catch_sigint)